@@ -0,0 +1,223 @@
+import sys
+version = sys.version_info
+if version.major < 3 or (version.major == 3 and version.minor < 10):
+	raise RuntimeError("This script requires Python 3.10 or higher")
+import heapq
+import io
+import itertools
+import os
+import tempfile
+import traceback
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import BinaryIO, Iterable, Iterator
+try:
+	import orjson as json
+except ImportError:
+	import json
+	print("Recommended to install 'orjson' for faster JSON parsing")
+
+from fileStreams import getZstFileRowStream
+from utils import FileProgressLog
+from zst_blocks_format.python_cli.ZstBlocksFile import ZstBlocksFile
+
+# Converts old .zst dumps into .zst_blocks files. Next to each output file a
+# "<name>.zst_blocks.meta" file is written with one JSON line per block:
+# {"block", "offset", "size", "rowCount", "minCreatedUtc", "maxCreatedUtc", "subreddits"}
+fileOrFolderPath = r"E:\reddit\comments"
+recursive = False
+rowsPerBlock = 256
+# re-sort rows by created_utc and id (secondary)
+sortRows = False
+# max number of rows that are sorted in memory at once, larger files are sorted in runs and merged
+sortRunSize = 1_000_000
+workers = os.cpu_count() or 1
+overwrite = False
+
+def parseRow(line: bytes) -> dict|None:
+	try:
+		return json.loads(line)
+	except json.JSONDecodeError:
+		print("Error parsing line: " + line.decode("utf-8", "replace"))
+		traceback.print_exc()
+		return None
+
+def getCreatedUtc(row: dict) -> int:
+	return int(float(row.get("created_utc", row.get("created", 0))))
+
+def getSortKey(line: bytes) -> tuple[int, int]:
+	row = parseRow(line)
+	if row is None:
+		return (0, 0)
+	try:
+		return (getCreatedUtc(row), int(row.get("id", "0"), 36))
+	except (TypeError, ValueError):
+		return (0, 0)
+
+def toJsonLine(obj: dict) -> bytes:
+	data = json.dumps(obj)
+	if isinstance(data, str):
+		data = data.encode("utf-8")
+	return data + b"\n"
+
+def batched(rows: Iterable[bytes], size: int) -> Iterator[list[bytes]]:
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if len(batch) > 0:
+		yield batch
+
+def compressBlock(rows: list[bytes], withMeta: bool) -> tuple[bytes, dict|None]:
+	buffer = io.BytesIO()
+	ZstBlocksFile.writeBlocksStream(buffer, [rows])
+	if not withMeta:
+		return buffer.getvalue(), None
+
+	minCreatedUtc: int|None = None
+	maxCreatedUtc: int|None = None
+	subreddits = set()
+	for line in rows:
+		row = parseRow(line)
+		if row is None:
+			continue
+		try:
+			createdUtc = getCreatedUtc(row)
+			minCreatedUtc = createdUtc if minCreatedUtc is None else min(minCreatedUtc, createdUtc)
+			maxCreatedUtc = createdUtc if maxCreatedUtc is None else max(maxCreatedUtc, createdUtc)
+		except (TypeError, ValueError):
+			pass
+		subreddit = row.get("subreddit")
+		if subreddit:
+			subreddits.add(subreddit)
+	meta = {
+		"rowCount": len(rows),
+		"minCreatedUtc": minCreatedUtc,
+		"maxCreatedUtc": maxCreatedUtc,
+		"subreddits": sorted(subreddits),
+	}
+	return buffer.getvalue(), meta
+
+def writeBlocks(outFile: BinaryIO, metaFile: BinaryIO|None, blocks: Iterable[list[bytes]], executor: Executor) -> int:
+	"""Compresses blocks in parallel and writes them in order. Returns the number of written blocks."""
+	pending: deque[Future] = deque()
+	maxPending = workers * 4
+	offset = outFile.tell()
+	blockCount = 0
+
+	def writeNext():
+		nonlocal offset, blockCount
+		blockBytes, meta = pending.popleft().result()
+		outFile.write(blockBytes)
+		if metaFile is not None:
+			metaFile.write(toJsonLine({ "block": blockCount, "offset": offset, "size": len(blockBytes), **meta }))
+		offset += len(blockBytes)
+		blockCount += 1
+
+	for rows in blocks:
+		pending.append(executor.submit(compressBlock, rows, metaFile is not None))
+		if len(pending) >= maxPending:
+			writeNext()
+	while pending:
+		writeNext()
+	return blockCount
+
+def sortedRowStream(rows: Iterable[bytes], tmpDir: str, executor: Executor) -> Iterator[bytes]:
+	runs = batched(rows, sortRunSize)
+	firstRun = next(runs, [])
+	secondRun = next(runs, None)
+	if secondRun is None:
+		firstRun.sort(key=getSortKey)
+		yield from firstRun
+		return
+
+	runPaths = []
+	for run in itertools.chain((firstRun, secondRun), runs):
+		run.sort(key=getSortKey)
+		runPath = os.path.join(tmpDir, f"run_{len(runPaths)}.zst_blocks")
+		with open(runPath, "wb") as runFile:
+			writeBlocks(runFile, None, batched(run, rowsPerBlock), executor)
+		runPaths.append(runPath)
+		print(f"\nSorted run {len(runPaths)}")
+
+	runFiles = [open(runPath, "rb") for runPath in runPaths]
+	try:
+		yield from heapq.merge(*(ZstBlocksFile.streamRows(runFile) for runFile in runFiles), key=getSortKey)
+	finally:
+		for runFile in runFiles:
+			runFile.close()
+
+def processFile(path: str):
+	if not path.endswith(".zst"):
+		print(f"Skipping non .zst file {path}")
+		return
+	outPath = path + "_blocks"
+	metaPath = outPath + ".meta"
+	if os.path.exists(outPath) and not overwrite:
+		print(f"Skipping {path}, {outPath} already exists")
+		return
+	tmpOutPath = outPath + ".tmp"
+	tmpMetaPath = metaPath + ".tmp"
+
+	print(f"Converting {path} to {outPath}")
+	try:
+		with (
+			open(path, "rb") as f,
+			open(tmpOutPath, "wb") as outFile,
+			open(tmpMetaPath, "wb") as metaFile,
+			tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outPath))) as tmpDir,
+			ProcessPoolExecutor(workers) as executor,
+		):
+			progressLog = FileProgressLog(path, f)
+			def rowStream() -> Iterator[bytes]:
+				for row in getZstFileRowStream(f, strict=True):
+					progressLog.onRow()
+					yield row
+
+			rows = rowStream()
+			if sortRows:
+				rows = sortedRowStream(rows, tmpDir, executor)
+			blockCount = writeBlocks(outFile, metaFile, batched(rows, rowsPerBlock), executor)
+			if progressLog.i > 0:
+				progressLog.logProgress("\n")
+
+		os.replace(tmpOutPath, outPath)
+		os.replace(tmpMetaPath, metaPath)
+	except Exception:
+		print(f"Error converting {path}")
+		traceback.print_exc()
+		return
+	finally:
+		for tmpPath in (tmpOutPath, tmpMetaPath):
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+	print(f"Wrote {progressLog.i:,} rows in {blockCount:,} blocks to {outPath}")
+
+def processFolder(path: str):
+	fileIterator: Iterable[str]
+	if recursive:
+		def recursiveFileIterator():
+			for root, dirs, files in os.walk(path):
+				for file in files:
+					yield os.path.join(root, file)
+		fileIterator = recursiveFileIterator()
+	else:
+		fileIterator = os.listdir(path)
+		fileIterator = (os.path.join(path, file) for file in fileIterator)
+
+	for i, file in enumerate(fileIterator):
+		print(f"Processing file {i+1: 3} {file}")
+		processFile(file)
+
+def main():
+	if os.path.isdir(fileOrFolderPath):
+		processFolder(fileOrFolderPath)
+	else:
+		processFile(fileOrFolderPath)
+
+	print("Done :>")
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,9 @@
+import io
+import os
+import random
+import struct
 import traceback
-from typing import BinaryIO, Iterator
+from typing import BinaryIO, Callable, Iterable, Iterator
 try:
 	import orjson as json
 except ImportError:
@@ -48,6 +52,34 @@ def getZstFileJsonStream(f: BinaryIO, chunk_size=1024*1024*10) -> Iterator[dict]
 			print(traceback.format_exc())
 			pass
 
+def getZstFileRowStream(f: BinaryIO, chunk_size=1024*1024*10, strict=False) -> Iterator[bytes]:
+	"""Yields the raw, undecoded lines of a .zst file
+
+	With `strict`, read errors are raised instead of ending the stream early"""
+	decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
+	zstReader = decompressor.stream_reader(f)
+	remainder = b""
+	while True:
+		try:
+			chunk = zstReader.read(chunk_size)
+		except zstandard.ZstdError:
+			if strict:
+				raise
+			print("Error reading zst chunk")
+			traceback.print_exc()
+			# the last line is most likely cut off
+			return
+		if not chunk:
+			break
+		lines = (remainder + chunk).split(b"\n")
+		remainder = lines[-1]
+		for line in lines[:-1]:
+			if line:
+				yield line
+
+	if len(remainder) > 0:
+		yield remainder
+
 def getJsonLinesFileJsonStream(f: BinaryIO) -> Iterator[dict]:
 	for line in f:
 		line = line.decode("utf-8", errors="replace")
@@ -77,3 +109,321 @@ def getFileJsonStream(path: str, f: BinaryIO) -> Iterator[dict]|None:
 		return getZstBlocksFileJsonStream(f)
 	else:
 		return None
+
+
+_zstFrameMagic = 0xFD2FB528
+_zstSeekableMagic = 0x8F92EAB1
+
+def _parseJsonRows(rows: Iterable[bytes]) -> Iterator[dict]:
+	for row in rows:
+		try:
+			yield json.loads(row)
+		except json.JSONDecodeError:
+			print("Error parsing line: " + row.decode("utf-8", errors="replace"))
+			traceback.print_exc()
+			continue
+
+def _getStrata(count: int, sampleCount: int) -> Iterator[range]:
+	for i in range(sampleCount):
+		yield range(i * count // sampleCount, (i + 1) * count // sampleCount)
+
+def _readZstBlocksMeta(metaPath: str) -> list[dict]:
+	blocks = []
+	with open(metaPath, "rb") as metaFile:
+		for line in metaFile:
+			if not line.strip():
+				continue
+			# the subreddits list is by far the largest part of a line and isn't needed here
+			subredditsStart = line.find(b'"subreddits"')
+			if subredditsStart != -1:
+				line = line[:subredditsStart].rstrip(b", ") + b"}"
+			blocks.append(json.loads(line))
+	return blocks
+
+def _blocksCoverFile(blocks: list[dict], fileSize: int) -> bool:
+	offset = 0
+	for block in blocks:
+		if block.get("offset") != offset or not isinstance(block.get("size"), int):
+			return False
+		offset += block["size"]
+	return offset == fileSize
+
+def getZstBlocksFileBlocks(path: str, f: BinaryIO) -> list[dict]:
+	"""Returns the blocks of a .zst_blocks file, from its .meta file if it matches the file, otherwise by scanning the block headers"""
+	metaPath = path + ".meta"
+	if os.path.exists(metaPath):
+		f.seek(0, 2)
+		try:
+			blocks = _readZstBlocksMeta(metaPath)
+			if _blocksCoverFile(blocks, f.tell()):
+				return blocks
+		except json.JSONDecodeError:
+			traceback.print_exc()
+		print(f"{metaPath} doesn't match {path}, scanning block headers instead")
+
+	blocks = []
+	f.seek(0)
+	offset = 0
+	while True:
+		header = f.read(4)
+		if len(header) < 4:
+			break
+		size = 4 + struct.unpack("<I", header)[0]
+		blocks.append({ "block": len(blocks), "offset": offset, "size": size })
+		offset += size
+		f.seek(offset)
+	return blocks
+
+def getZstSeekableFrames(f: BinaryIO) -> list[tuple[int, int, int]]|None:
+	"""Returns (offset, compressedSize, decompressedSize) of all frames, if the file uses the zstd seekable format"""
+	f.seek(0, 2)
+	fileSize = f.tell()
+	if fileSize < 17:
+		return None
+	f.seek(fileSize - 9)
+	frameCount, descriptor, magic = struct.unpack("<IBI", f.read(9))
+	if magic != _zstSeekableMagic:
+		return None
+	entrySize = 12 if descriptor & 0x80 else 8
+	f.seek(fileSize - 9 - frameCount * entrySize)
+	seekTable = f.read(frameCount * entrySize)
+	frames = []
+	offset = 0
+	for i in range(frameCount):
+		compressedSize, decompressedSize = struct.unpack_from("<II", seekTable, i * entrySize)
+		frames.append((offset, compressedSize, decompressedSize))
+		offset += compressedSize
+	return frames
+
+def _walkZstFrames(f: BinaryIO) -> list[tuple[int, int, int|None]]|None:
+	"""Finds the frames of a .zst file by walking the frame and block headers, without decompressing anything
+
+	Returns (offset, compressedSize, decompressedSize) of all frames, decompressedSize is None if
+	the frame header doesn't contain it. Returns None if the file isn't a valid zstd file."""
+	f.seek(0, 2)
+	fileSize = f.tell()
+	frames = []
+	offset = 0
+	while offset < fileSize:
+		f.seek(offset)
+		header = f.read(18)
+		if len(header) < 8:
+			return None
+		magic = struct.unpack_from("<I", header)[0]
+		if magic & 0xFFFFFFF0 == 0x184D2A50:
+			# skippable frame
+			offset += 8 + struct.unpack_from("<I", header, 4)[0]
+			continue
+		if magic != _zstFrameMagic:
+			return None
+		descriptor = header[4]
+		singleSegment = descriptor >> 5 & 1
+		hasChecksum = descriptor >> 2 & 1
+		dictIdSize = (0, 1, 2, 4)[descriptor & 3]
+		contentSizeSize = (singleSegment, 2, 4, 8)[descriptor >> 6]
+		contentSizeStart = 5 + (1 - singleSegment) + dictIdSize
+		decompressedSize = None
+		if contentSizeSize > 0:
+			decompressedSize = int.from_bytes(header[contentSizeStart:contentSizeStart + contentSizeSize], "little")
+			if contentSizeSize == 2:
+				decompressedSize += 256
+
+		blockOffset = offset + contentSizeStart + contentSizeSize
+		while True:
+			f.seek(blockOffset)
+			blockHeader = f.read(3)
+			if len(blockHeader) < 3:
+				return None
+			blockHeaderValue = int.from_bytes(blockHeader, "little")
+			blockType = blockHeaderValue >> 1 & 3
+			if blockType == 3:
+				return None
+			# RLE blocks store a single byte
+			blockOffset += 3 + (1 if blockType == 1 else blockHeaderValue >> 3)
+			if blockHeaderValue & 1:
+				break
+		frameEnd = blockOffset + 4 * hasChecksum
+		frames.append((offset, frameEnd - offset, decompressedSize))
+		offset = frameEnd
+	return frames
+
+def getZstFrames(f: BinaryIO) -> list[tuple[int, int, int|None]]|None:
+	"""Returns the frames of a .zst file, from the seek table if present, otherwise by walking the headers.
+	Returns None for single frame files, since they can't be sampled without reading everything."""
+	frames = getZstSeekableFrames(f)
+	if frames is None:
+		frames = _walkZstFrames(f)
+	if frames is None or len(frames) < 2:
+		return None
+	return frames
+
+class JsonSampleStream:
+	"""Reproducible random sample of the rows of a file.
+
+	- .zst_blocks: one random block per time stratum, only those blocks are decompressed
+	- .zst: one random frame per stratum, for files with multiple frames (seekable format, pzstd, ...).
+	  Frames are found through the seek table or by walking the frame headers.
+	- otherwise (including the single frame pushshift dumps) every row is read and kept with probability `fraction`
+
+	`estimatedFraction` is the estimated share of all rows that ended up in the sample.
+	Counts from the sample can be scaled up by `1 / estimatedFraction`. It is final once
+	the stream has been fully iterated.
+	"""
+	path: str
+	file: BinaryIO
+	fraction: float
+	seed: int|None
+	estimatedFraction: float
+	sampledRows: int
+
+	def __init__(self, path: str, file: BinaryIO, fraction: float, seed: int|None = None):
+		if not 0 < fraction <= 1:
+			raise ValueError(f"Sampling fraction must be in (0, 1], got {fraction}")
+		self.path = path
+		self.file = file
+		self.fraction = fraction
+		self.seed = seed
+		self.estimatedFraction = fraction
+		self.sampledRows = 0
+
+	def __iter__(self) -> Iterator[dict]:
+		self.sampledRows = 0
+		rng = random.Random(self.seed)
+		if self.path.endswith(".zst_blocks"):
+			rows = self._sampleZstBlocks(rng)
+		elif self.path.endswith(".zst") and (frames := getZstFrames(self.file)) is not None:
+			rows = self._sampleZstFrames(rng, frames)
+		elif self.path.endswith(".zst"):
+			self.file.seek(0)
+			rows = self._sampleRows(rng, getZstFileRowStream(self.file))
+		else:
+			self.file.seek(0)
+			rows = self._sampleRows(rng, self.file)
+		for row in _parseJsonRows(rows):
+			self.sampledRows += 1
+			yield row
+
+	def _sampleZstBlocks(self, rng: random.Random) -> Iterator[bytes]:
+		blocks = getZstBlocksFileBlocks(self.path, self.file)
+		if len(blocks) == 0:
+			return
+		sampleCount = max(1, round(len(blocks) * self.fraction))
+		timeOrdered = sorted(blocks, key=lambda block: (block.get("minCreatedUtc") or 0, block["offset"]))
+		sampledBlocks = [timeOrdered[rng.choice(stratum)] for stratum in _getStrata(len(blocks), sampleCount)]
+		sampledBlocks.sort(key=lambda block: block["offset"])
+
+		if all("rowCount" in block for block in blocks):
+			totalRows = sum(block["rowCount"] for block in blocks)
+			sampledRows = sum(block["rowCount"] for block in sampledBlocks)
+			self.estimatedFraction = sampledRows / totalRows if totalRows > 0 else 1
+		else:
+			self.estimatedFraction = sampleCount / len(blocks)
+
+		for block in sampledBlocks:
+			self.file.seek(block["offset"])
+			blockBytes = io.BytesIO(self.file.read(block["size"]))
+			yield from ZstBlocksFile.streamRows(blockBytes)
+
+	def _sampleZstFrames(self, rng: random.Random, frames: list[tuple[int, int, int|None]]) -> Iterator[bytes]:
+		if len(frames) == 0:
+			return
+		sampleCount = max(1, round(len(frames) * self.fraction))
+		sampledFrames = [rng.choice(stratum) for stratum in _getStrata(len(frames), sampleCount)]
+		# without decompressed sizes, the compressed sizes are the best estimate
+		sizeIndex = 2 if all(frame[2] is not None for frame in frames) else 1
+		totalSize = sum(frame[sizeIndex] for frame in frames)
+		sampledSize = sum(frames[i][sizeIndex] for i in sampledFrames)
+		self.estimatedFraction = sampledSize / totalSize if totalSize > 0 else 1
+
+		decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
+		lastFrame: tuple[int, bytes]|None = None
+		lastBytes: dict[int, bytes] = {}
+		def readCompressedFrame(i: int) -> bytes:
+			offset, compressedSize, _ = frames[i]
+			self.file.seek(offset)
+			return self.file.read(compressedSize)
+		def readFrame(i: int) -> bytes:
+			# the frame following a sampled frame is often needed again, by the next stratum
+			nonlocal lastFrame
+			if lastFrame is None or lastFrame[0] != i:
+				data = decompressor.decompressobj().decompress(readCompressedFrame(i))
+				lastFrame = (i, data)
+				lastBytes[i] = data[-1:]
+			return lastFrame[1]
+		def readLastByte(i: int) -> bytes:
+			# streams through the frame, without holding its decompressed content in memory
+			if i not in lastBytes:
+				reader = decompressor.stream_reader(io.BytesIO(readCompressedFrame(i)))
+				lastByte = b""
+				while chunk := reader.read(1024*1024):
+					lastByte = chunk[-1:]
+				lastBytes[i] = lastByte
+			return lastBytes[i]
+		def startsMidLine(i: int) -> bool:
+			# skip empty frames, they don't tell where the previous line ended
+			for previousIndex in range(i - 1, -1, -1):
+				if frames[previousIndex][2] == 0:
+					continue
+				lastByte = readLastByte(previousIndex)
+				if len(lastByte) > 0:
+					return lastByte != b"\n"
+			return False
+
+		for frameIndex in sampledFrames:
+			# frames don't have to align with lines, a line belongs to the frame it starts in
+			data = readFrame(frameIndex)
+			start = 0
+			if startsMidLine(frameIndex):
+				start = data.find(b"\n") + 1
+				if start == 0:
+					continue
+			lines = data[start:].split(b"\n")
+			remainder = lines.pop()
+			yield from (line for line in lines if line)
+			nextIndex = frameIndex + 1
+			while len(remainder) > 0 and nextIndex < len(frames):
+				data = readFrame(nextIndex)
+				end = data.find(b"\n")
+				if end != -1:
+					remainder += data[:end]
+					break
+				remainder += data
+				nextIndex += 1
+			if len(remainder) > 0:
+				yield remainder
+
+	def _sampleRows(self, rng: random.Random, rows: Iterable[bytes]) -> Iterator[bytes]:
+		totalRows = 0
+		sampledRows = 0
+		for row in rows:
+			totalRows += 1
+			if rng.random() < self.fraction:
+				sampledRows += 1
+				yield row
+		self.estimatedFraction = sampledRows / totalRows if totalRows > 0 else 1
+
+def getFileJsonSampleStream(path: str, f: BinaryIO, fraction: float, seed: int|None = None) -> JsonSampleStream|None:
+	if not path.endswith((".jsonl", ".zst", ".zst_blocks")):
+		return None
+	return JsonSampleStream(path, f, fraction, seed)
+
+def reservoirSample(stream: Iterable[dict], size: int, rowFilter: Callable[[dict], bool]|None = None, seed: int|None = None) -> tuple[list[dict], int]:
+	"""Uniformly samples up to `size` rows that match `rowFilter`.
+
+	Returns the sampled rows and the number of matching rows. The sampling fraction of
+	the matching rows is `len(rows) / matchCount`. If `stream` is a JsonSampleStream,
+	multiply with its `estimatedFraction`."""
+	rng = random.Random(seed)
+	reservoir: list[dict] = []
+	matchCount = 0
+	for row in stream:
+		if rowFilter is not None and not rowFilter(row):
+			continue
+		matchCount += 1
+		if len(reservoir) < size:
+			reservoir.append(row)
+		else:
+			i = rng.randrange(matchCount)
+			if i < size:
+				reservoir[i] = row
+	return reservoir, matchCount